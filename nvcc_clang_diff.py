@@ -5,14 +5,17 @@
 Useful for figuring out what nvcc argument patching is needed for acceptance by clangd, if we ever need to update that logic in refresh.template.py
 """
 
+import concurrent.futures
 import dataclasses
 import functools
+import re
 import shutil
 import subprocess
 
 @functools.total_ordering
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
 class Flag:
+    __slots__ = ("long", "short", "has_args") # Rather than dataclass(slots=True), which needs Python 3.10
     long: str
     short: str
     has_args: bool
@@ -20,18 +23,11 @@ class Flag:
     def __lt__(self, other):
         return (self.long, self.short) < (other.long, other.short)
 
-def flag_key(flag):
-    if "=" in flag:
-        return flag[:flag.index("=")]
-    return flag
-
 def get_nvcc_flags() -> list[Flag]:
     nvcc = shutil.which("nvcc") or "/usr/local/cuda/bin/nvcc"
     help_output = subprocess.check_output([nvcc, "--help"], text=True, stderr=subprocess.STDOUT)
     flags = []
-    for line in help_output.splitlines():
-        if not line.startswith("--"):
-            continue
+    for line in NVCC_FLAG_LINE_PATTERN.findall(help_output):
         # looks like --long args (-short)
         line_parts = line.split()
         short = line_parts[-1]
@@ -39,18 +35,24 @@ def get_nvcc_flags() -> list[Flag]:
             short = short[1:-1]
         flags.append(Flag(line_parts[0], short, has_args = len(line_parts) > 2))
     return flags
+NVCC_FLAG_LINE_PATTERN = re.compile(r"^--.*", re.MULTILINE)
 
 def get_clang_flags() -> set[str]:
     clang = shutil.which("clang") or "/usr/bin/clang"
     help_output = subprocess.check_output([clang, "--help"], text=True, stderr=subprocess.STDOUT)
-    flags = set(flag_key(token) for token in help_output.split() if token.startswith("-"))
+    flags = set(CLANG_FLAG_KEY_PATTERN.findall(help_output))
     # Fix this up manually based on https://clang.llvm.org/docs/ClangCommandLineReference.html
     flags |= {"-Wreorder", "-Wno-deprecated-declarations", "-Werror", "-O", "--help", "-l", "-m64", "--shared", "-shared"}
     return flags
+CLANG_FLAG_KEY_PATTERN = re.compile(r"(?<!\S)-[^\s=]*") # Whitespace-separated tokens starting with -, up to any =, so flags taking values are keyed by name
 
 def main():
-    nvcc_flags = get_nvcc_flags()
-    clang_flags = get_clang_flags()
+    # Query both compilers at once, since we're just waiting on their subprocesses.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        nvcc_flags_future = executor.submit(get_nvcc_flags)
+        clang_flags_future = executor.submit(get_clang_flags)
+        nvcc_flags = nvcc_flags_future.result()
+        clang_flags = clang_flags_future.result()
 
     nvcc_flags_no_arg = []
     nvcc_flags_with_arg = []
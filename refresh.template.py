@@ -29,14 +29,23 @@ import pathlib
 import re
 import shlex
 import shutil
+try:
+    import sqlite3
+except ImportError:  # It's an optional part of the standard library, missing from some Python builds. We'll just run without the header cache.
+    sqlite3 = None
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import types
 import typing  # MIN_PY=3.9: Switch e.g. typing.List[str] -> List[str]
 
 
+# Encoding for subprocess output. Looked up once, since we spawn a subprocess for (nearly) every compile action, and the lookup touches global locale state.
+PREFERRED_ENCODING = locale.getpreferredencoding()
+
+
 @enum.unique
 class SGR(enum.Enum):
     """Enumerate (some of the) available SGR (Select Graphic Rendition) control sequences."""
@@ -108,7 +117,7 @@ def _get_bazel_version():
         # MIN_PY=3.7: Replace PIPEs with capture_output.
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        encoding=locale.getpreferredencoding(),
+        encoding=PREFERRED_ENCODING,
         check=True, # Should always succeed.
     )
 
@@ -134,18 +143,13 @@ def _get_bazel_cached_action_keys():
         # MIN_PY=3.7: Replace PIPEs with capture_output.
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        encoding=locale.getpreferredencoding(),
+        encoding=PREFERRED_ENCODING,
         check=True, # Should always succeed.
     )
 
-    action_keys = set()
-    marked_as_empty = False # Sometimes the action cache is empty...despite having built this file, so we have to handle that case. See https://github.com/hedronvision/bazel-compile-commands-extractor/issues/64
-    for line in action_cache_process.stdout.splitlines():
-        line = line.strip()
-        if line.startswith('actionKey = '):
-            action_keys.add(line[12:]) # Remainder after actionKey =
-        elif line.startswith('Action cache (0 records):'):
-            marked_as_empty = True
+    # Scan the whole (large) dump at once, rather than line by line.
+    action_keys = frozenset(BAZEL_ACTION_KEY_PATTERN.findall(action_cache_process.stdout))
+    marked_as_empty = 'Action cache (0 records):' in action_cache_process.stdout # Sometimes the action cache is empty...despite having built this file, so we have to handle that case. See https://github.com/hedronvision/bazel-compile-commands-extractor/issues/64
 
     # Make sure we get notified of changes to the format, since bazel dump --action_cache isn't public API.
     # We continue gracefully, rather than asserting, because we can (conservatively) continue without hitting cache.
@@ -153,6 +157,7 @@ def _get_bazel_cached_action_keys():
         log_warning(">>> Failed to get action keys from Bazel.\nPlease file an issue with the following log:\n", action_cache_process.stdout)
 
     return action_keys
+BAZEL_ACTION_KEY_PATTERN = re.compile(r'^[ \t]*actionKey = (.*?)[ \t]*$', re.MULTILINE)
 
 
 def _parse_headers_from_makefile_deps(d_file_content: str, source_path_for_sanity_check: typing.Optional[str] = None):
@@ -174,17 +179,33 @@ def _parse_headers_from_makefile_deps(d_file_content: str, source_path_for_sanit
     target, dependencies = d_file_content.split(': ', 1)  # Needs to handle absolute Windows paths, like C:\
     target = target.strip()  # Remove the optional trailing space.
     assert target.endswith(('.o', '.obj')), "Something went wrong in makefile parsing to get headers. The target should be an object file. Output:\n" + d_file_content
-    # Undo shell-like line wrapping because the newlines aren't eaten by shlex.join. Note also that it's the line wrapping is inconsistently generated across compilers and depends on the lengths of the filenames, so you can't just split on the escaped newlines.
-    dependencies = dependencies.replace('\\\n', '')
-    # On Windows, swap out (single) backslash path directory separators for forward slash. Shlex otherwise eats the separators...and Windows gcc intermixes backslash separators with backslash escaped spaces. For a real example of gcc run from Windows, see https://github.com/hedronvision/bazel-compile-commands-extractor/issues/81
-    if os.name == 'nt':
-        dependencies = re.sub(r'\\(?=[^ \\])', '/', dependencies)
-    # We'll use shlex.split as a good proxy for escaping, but note that Makefiles themselves [don't seem to really support escaping spaces](https://stackoverflow.com/questions/30687828/how-to-escape-spaces-inside-a-makefile).
-    dependencies = shlex.split(dependencies)
+    # On Windows, swap out (single) backslash path directory separators for forward slash. Unescaping otherwise eats the separators...and Windows gcc intermixes backslash separators with backslash escaped spaces. For a real example of gcc run from Windows, see https://github.com/hedronvision/bazel-compile-commands-extractor/issues/81
+    if os.name == 'nt' and '\\' in dependencies: # Quick check first, since toolchains often already emit forward slashes.
+        dependencies = MAKEFILE_WINDOWS_SEPARATOR_PATTERN.sub('/', dependencies)
+    # Split into paths in a single regex pass, treating the shell-like line wrapping (escaped newlines) as just more whitespace. Note that the line wrapping is inconsistently generated across compilers and depends on the lengths of the filenames, so you can't just split on the escaped newlines.
+    # We then undo shell-like backslash escaping, as shlex.split would have, but note that Makefiles themselves [don't seem to really support escaping spaces](https://stackoverflow.com/questions/30687828/how-to-escape-spaces-inside-a-makefile).
+    dependencies = [MAKEFILE_ESCAPE_PATTERN.sub(r'\1', path) if '\\' in path else path for path in MAKEFILE_PATH_PATTERN.findall(dependencies)]
     source, *headers = dependencies  # The first dependency is a source entry, only used to (optionally) sanity-check the dependencies if a source path is provided.
     assert source_path_for_sanity_check is None or source.endswith(source_path_for_sanity_check), "Something went wrong in makefile parsing to get headers. The first dependency should be the source file. Output:\n" + d_file_content
     # Make the headers unique, because GCC [sometimes emits duplicate entries](https://github.com/hedronvision/bazel-compile-commands-extractor/issues/7#issuecomment-975109458).
     return set(headers)
+MAKEFILE_PATH_PATTERN = re.compile(r'(?:\\[^\n]|[^\s\\])+') # Runs of escaped characters and non-whitespace. Escaped newlines are line wrapping, not part of any path.
+MAKEFILE_ESCAPE_PATTERN = re.compile(r'\\(.)')
+MAKEFILE_WINDOWS_SEPARATOR_PATTERN = re.compile(r'\\(?=[^\s\\])') # Single backslashes that aren't escaping whitespace (or another backslash).
+
+
+@functools.lru_cache(maxsize=None)
+def _get_cached_directory_entries(directory: str):
+    """Returns {name: os.DirEntry} for the contents of a directory, or an empty dict if it can't be listed.
+
+    Only worth it on Windows, where scandir hands us the modification times along with the listing, so all the sibling headers in a directory share one call.
+    Elsewhere, DirEntry.stat() is a stat syscall per file anyway, so listing the directory first would just add work. Hence the os.name checks at the call sites.
+    """
+    try:
+        with os.scandir(directory or '.') as entries:
+            return {entry.name: entry for entry in entries}
+    except OSError:  # The directory doesn't exist or is inaccessible.
+        return {}
 
 
 @functools.lru_cache(maxsize=None)
@@ -194,6 +215,12 @@ def _get_cached_modified_time(path: str):
     Without the cache, most of our runtime in the cached case is `stat`'ing the same headers repeatedly.
     """
     try:
+        if os.name == 'nt':
+            directory, name = os.path.split(path)
+            entry = _get_cached_directory_entries(directory).get(name)
+            if entry is not None:
+                return entry.stat().st_mtime  # Follows symlinks, which Bazel's trees are full of. Cached on the entry.
+            # Not listed under that exact name. Fall back, since the path might differ in case on a case-insensitive filesystem, or contain `..`.
         return os.path.getmtime(path)
     except OSError:  # The file doesn't exist or is inaccessible.
         # For our purposes, this means we don't have a newer version, so we'll return a very old time that'll always qualify the cache as fresh in a comparison. There are two cases here:
@@ -206,6 +233,18 @@ def _get_cached_file_exists(path: str):
     return _get_cached_modified_time(path) != 0
 
 
+def _get_cached_is_file(path: str):
+    """Like os.path.isfile, but answered from the cached directory listings on Windows, where those are worth building. See _get_cached_directory_entries."""
+    if os.name == 'nt':
+        directory, name = os.path.split(path)
+        entry = _get_cached_directory_entries(directory).get(name)
+        if entry is not None:
+            return entry.is_file()  # Follows symlinks. Usually free, from the listing itself.
+        # Not listed under that exact name. Fall back, as in _get_cached_modified_time.
+    return os.path.isfile(path)
+
+
+@functools.lru_cache(maxsize=None)
 def _get_cached_adjusted_modified_time(path: str):
     """Get the modified time of a file, slightly adjusted for easy comparison.
 
@@ -215,7 +254,7 @@ def _get_cached_adjusted_modified_time(path: str):
     For bazel's internal sources, which have timestamps 10 years in the future, also return 0.
 
     Without the cache, most of our runtime in the cached case is `stat`'ing the same headers repeatedly.
-    Cache shared with _get_cached_modified_time
+    Underlying stats shared with _get_cached_modified_time, but cached separately, too, so repeat lookups don't even need to run any Python.
     """
     mtime = _get_cached_modified_time(path)
 
@@ -228,11 +267,22 @@ def _get_cached_adjusted_modified_time(path: str):
 BAZEL_INTERNAL_SOURCE_CUTOFF = time.time() + 60*60*24*365
 
 
+def _are_cached_files_unmodified_since(paths: typing.Iterable[str], timestamp: float):
+    """Check whether none of the files have been modified after timestamp, as when checking that a cache of included headers is fresh.
+
+    Files that don't exist count as unmodified. See _get_cached_adjusted_modified_time.
+    """
+    # max over map, rather than all over a generator, because it keeps the loop entirely in C when the modified times are cached. That's faster in the common, fresh case, even though it can't exit early in the stale case.
+    return max(map(_get_cached_adjusted_modified_time, paths), default=0) <= timestamp
+
+
+@functools.lru_cache(maxsize=None)
 def _is_nvcc(path: str):
+    """Check whether the compiler is nvcc. Cached, since it's checked several times per action, but there are only ever a handful of distinct compilers."""
     return os.path.basename(path).startswith('nvcc')
 
 
-def _get_headers_gcc(compile_action, source_path: str, action_key: str):
+def _get_headers_gcc(compile_action, source_path: str, dep_file_path: typing.Optional[str]):
     """Gets the headers used by a particular compile command that uses gcc arguments formatting (including clang.)
 
     Relatively slow. Requires running the C preprocessor if we can't hit Bazel's cache.
@@ -240,49 +290,50 @@ def _get_headers_gcc(compile_action, source_path: str, action_key: str):
     # Flags reference here: https://clang.llvm.org/docs/ClangCommandLineReference.html
 
     # Check to see if Bazel has an (approximately) fresh cache of the included headers, and if so, use them to avoid a slow preprocessing step.
-    if action_key in _get_bazel_cached_action_keys():  # Safe because Bazel only holds one cached action key per path, and the key contains the path.
-        for i, arg in enumerate(compile_action.arguments):
-            if arg.startswith('-MF'):
-                if len(arg) > 3: # Either appended, like -MF<file>
-                    dep_file_path = arg[:3]
-                else: # Or after as a separate arg, like -MF <file>
-                    dep_file_path = compile_action.arguments[i+1]
-                if os.path.isfile(dep_file_path):
-                    dep_file_last_modified = os.path.getmtime(dep_file_path) # Do before opening just as a basic hedge against concurrent write, even though we won't handle the concurrent delete case perfectly.
-                    with open(dep_file_path) as dep_file:
-                        dep_file_contents = dep_file.read()
-                    headers = _parse_headers_from_makefile_deps(dep_file_contents)
-                    # Check freshness of dep file by making sure none of the files in it have been modified since its creation.
-                    if (_get_cached_adjusted_modified_time(source_path) <= dep_file_last_modified
-                        and all(_get_cached_adjusted_modified_time(header_path) <= dep_file_last_modified for header_path in headers)):
-                        return headers, True # Fresh cache! exit early. Still put in the Hedron outer cache bc we're willing to hit stale if we're unable to get new headers.
-                break
-
-    # Strip out existing dependency file generation that could interfere with ours.
-    # Clang on Apple doesn't let later flags override earlier ones, unfortunately.
-    # These flags are prefixed with M for "make", because that's their output format.
-    # *-dependencies is the long form. And the output file is traditionally *.d
-    header_cmd = (arg for arg in compile_action.arguments
-        if not arg.startswith('-M') and not arg.endswith(('-dependencies', '.d')))
-
-    # Strip output flags. Apple clang tries to do a full compile if you don't.
-    header_cmd = (arg for arg in header_cmd
-        if arg != '-o' and not arg.endswith('.o'))
-
-    # Strip sanitizer ignore lists...so they don't show up in the dependency list.
-    # See https://clang.llvm.org/docs/SanitizerSpecialCaseList.html and https://github.com/hedronvision/bazel-compile-commands-extractor/issues/34 for more context.
-    header_cmd = (arg for arg in header_cmd
-        if not arg.startswith('-fsanitize'))
+    # Checking that the dep file exists first (one cached stat) means we don't run `bazel dump` at all when nothing has been built, like after a clean.
+    if dep_file_path and _get_cached_file_exists(dep_file_path):
+        # The lookup is cached, but we also hold a lock, so the many threads processing actions don't all miss the cache at once, each running their own (slow) bazel dump.
+        with _get_headers_gcc.action_cache_lock:
+            bazel_cached_action_keys = _get_bazel_cached_action_keys()
+    else:
+        bazel_cached_action_keys = frozenset()
+    if compile_action.actionKey in bazel_cached_action_keys:  # Safe because Bazel only holds one cached action key per path, and the key contains the path.
+        dep_file_last_modified = _get_cached_modified_time(dep_file_path) # Reuses the (cached) modified time from the existence check above. Taken before opening just as a basic hedge against concurrent write.
+        try:
+            # Read as bytes and decode in one go, since these can be large. We then only pay for newline translation if there are Windows line endings.
+            with open(dep_file_path, 'rb') as dep_file:
+                dep_file_contents = dep_file.read().decode(PREFERRED_ENCODING)
+            if '\r' in dep_file_contents:
+                dep_file_contents = dep_file_contents.replace('\r\n', '\n')
+        except OSError: # The dep file was concurrently deleted or is inaccessible.
+            pass
+        else:
+            headers = _parse_headers_from_makefile_deps(dep_file_contents)
+            # Check freshness of dep file by making sure none of the files in it have been modified since its creation.
+            if _are_cached_files_unmodified_since(itertools.chain((source_path,), headers), dep_file_last_modified):
+                return headers, True # Fresh cache! exit early. Still put in the Hedron outer cache bc we're willing to hit stale if we're unable to get new headers.
+
+    # Filter the arguments in a single pass, stripping:
+    # - Existing dependency file generation that could interfere with ours.
+    #   Clang on Apple doesn't let later flags override earlier ones, unfortunately.
+    #   These flags are prefixed with M for "make", because that's their output format.
+    #   *-dependencies is the long form. And the output file is traditionally *.d
+    # - Output flags. Apple clang tries to do a full compile if you don't.
+    # - Sanitizer ignore lists...so they don't show up in the dependency list.
+    #   See https://clang.llvm.org/docs/SanitizerSpecialCaseList.html and https://github.com/hedronvision/bazel-compile-commands-extractor/issues/34 for more context.
+    header_cmd = [arg for arg in compile_action.arguments
+        if not arg.startswith(('-M', '-fsanitize')) and not arg.endswith(('-dependencies', '.d', '.o')) and arg != '-o']
 
     # Dump system and user headers to stdout...in makefile format.
     # Relies on our having made the workspace directory simulate a complete version of the execroot with //external symlink
-    header_cmd = list(header_cmd)
     is_nvcc = _is_nvcc(header_cmd[0])
     # https://docs.nvidia.com/cuda/cuda-compiler-driver-nvcc/index.html#nvcc-command-options
     if is_nvcc:
         header_cmd += ['--generate-dependencies']
     else:
         # -M rather than --dependencies allows us to support the zig compiler. See https://github.com/hedronvision/bazel-compile-commands-extractor/pull/130
+        # Note that -M implies -E, so the compiler only preprocesses--no compilation--writing just the dependencies to stdout. No need for -MF - or -o /dev/null.
+        # And -M rather than -MM, because we want system headers, too.
         header_cmd += ['-M', '--print-missing-file-dependencies'] # Allows us to continue on past missing (generated) files--whose paths may be wrong (listed as written in the include)!
 
     header_search_process = _subprocess_run_spilling_over_to_param_file_if_needed( # Note: gcc/clang can be run from Windows, too.
@@ -291,7 +342,7 @@ def _get_headers_gcc(compile_action, source_path: str, action_key: str):
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         env=compile_action.environmentVariables,
-        encoding=locale.getpreferredencoding(),
+        encoding=PREFERRED_ENCODING,
         check=False, # We explicitly ignore errors and carry on.
     )
 
@@ -312,11 +363,12 @@ def _get_headers_gcc(compile_action, source_path: str, action_key: str):
         should_cache = len(headers) == num_headers_output
 
     return headers, should_cache
+_get_headers_gcc.action_cache_lock = threading.Lock()
 
 
 def windows_list2cmdline(seq):
     """
-    Copied from list2cmdline in https://github.com/python/cpython/blob/main/Lib/subprocess.py because we need it but it's not exported as part of the public API.
+    Adapted from list2cmdline in https://github.com/python/cpython/blob/main/Lib/subprocess.py because we need it but it's not exported as part of the public API.
 
     Translate a sequence of arguments into a command line
     string, using the same rules as the MS C runtime:
@@ -341,44 +393,24 @@ def windows_list2cmdline(seq):
     # http://msdn.microsoft.com/en-us/library/17w5ykft.aspx
     # or search http://msdn.microsoft.com for
     # "Parsing C++ Command-Line Arguments"
+    # Unlike the CPython original, we escape with regexes rather than a character-by-character loop, since we only need this for (very) long commands.
     result = []
-    needquote = False
     for arg in map(os.fsdecode, seq):
-        bs_buf = []
-
-        # Add a space to separate this argument from the others
-        if result:
-            result.append(' ')
+        # Double any backslashes preceding a double quotation mark, and then escape the mark itself.
+        if '"' in arg:
+            arg = WINDOWS_BACKSLASHES_BEFORE_QUOTE.sub(r'\1\1\\"', arg)
 
         needquote = (" " in arg) or ("\t" in arg) or not arg
         if needquote:
-            result.append('"')
-
-        for c in arg:
-            if c == '\\':
-                # Don't know if we need to double yet.
-                bs_buf.append(c)
-            elif c == '"':
-                # Double backslashes.
-                result.append('\\' * len(bs_buf)*2)
-                bs_buf = []
-                result.append('\\"')
-            else:
-                # Normal char
-                if bs_buf:
-                    result.extend(bs_buf)
-                    bs_buf = []
-                result.append(c)
+            # Double any trailing backslashes, too, so they don't escape the closing quotation mark.
+            num_trailing_backslashes = len(arg) - len(arg.rstrip('\\'))
+            arg = '"' + arg + '\\' * num_trailing_backslashes + '"'
 
-        # Add remaining backslashes, if any.
-        if bs_buf:
-            result.extend(bs_buf)
+        result.append(arg)
 
-        if needquote:
-            result.extend(bs_buf)
-            result.append('"')
-
-    return ''.join(result)
+    # Arguments are delimited by spaces.
+    return ' '.join(result)
+WINDOWS_BACKSLASHES_BEFORE_QUOTE = re.compile(r'(\\*)"')
 
 
 def _subprocess_run_spilling_over_to_param_file_if_needed(command: typing.List[str], **kwargs):
@@ -428,61 +460,55 @@ def _get_headers_msvc(compile_action, source_path: str):
         # Bazel should have supplied the environment variables in aquery output but doesn't https://github.com/bazelbuild/bazel/issues/12852
     # Non-Bazel Windows users would normally configure these by calling vcvars
         # For more, see https://docs.microsoft.com/en-us/cpp/build/building-on-the-command-line
-    environment = compile_action.environmentVariables.copy()
-    if 'INCLUDE' not in environment:
-        environment['INCLUDE'] = os.pathsep.join((
-            # Begin: template filled by Bazel
-            {windows_default_include_paths}
-            # End:   template filled by Bazel
-        ))
+    # The action's environment dictionary is already ours alone, so we add to it in place, rather than copying for every action.
+    compile_action.environmentVariables.setdefault('INCLUDE', WINDOWS_DEFAULT_INCLUDE)
 
     header_search_process = _subprocess_run_spilling_over_to_param_file_if_needed(
         header_cmd,
         stderr=subprocess.PIPE,
         stdout=subprocess.DEVNULL,
-        env=environment,
-        encoding=locale.getpreferredencoding(),
+        env=compile_action.environmentVariables,
+        encoding=PREFERRED_ENCODING,
         check=False, # We explicitly ignore errors and carry on.
     )
 
-    # Based on the locale, `cl.exe` will emit different marker strings. See also https://github.com/ninja-build/ninja/issues/613#issuecomment-885185024 and https://github.com/bazelbuild/bazel/pull/7966.
-    # We can't just set environment['VSLANG'] = "1033" (English) and be done with it, because we can't assume the user has the English language pack installed.
-    # Note that, if we're ever having problems with MSVC changing these strings too often, we can instead infer them by compiling some test files and passing /nologo. See https://github.com/ninja-build/ninja/issues/613#issuecomment-1465084387
-    include_marker = (
-        'Note: including file:', # English - United States
-        '注意: 包含文件: ', # Chinese - People's Republic of China
-        '注意: 包含檔案:', # Chinese - Taiwan
-        'Poznámka: Včetně souboru:', # Czech
-        'Hinweis: Einlesen der Datei:', # German - Germany
-        'Remarque : inclusion du fichier : ', # French - France
-        'Nota: file incluso ', # Italian - Italy
-        'メモ: インクルード ファイル: ', # Japanese
-        '참고: 포함 파일:', # Korean
-        'Uwaga: w tym pliku: ', # Polish
-        'Observação: incluindo arquivo:', # Portuguese - Brazil
-        'Примечание: включение файла: ', # Russian
-        'Not: eklenen dosya: ', # Turkish
-        'Nota: inclusión del archivo:', # Spanish - Spain (Modern Sort)
-    )
-
-    headers = set() # Make unique. MSVC emits duplicate entries.
-    error_lines = []
-    for line in header_search_process.stderr.splitlines():
-        # Gobble up the header inclusion information...
-        if source_path.endswith('/' + line) or source_path == line: # Munching the source filename echoed the first part of the include output
-            continue
-        for marker in include_marker:
-            if line.startswith(marker):
-                headers.add(line[len(marker):].strip())
-                break
-        else:
-            error_lines.append(line)
+    # Gobble up the header inclusion information, scanning the whole output at once, rather than line by line, since there's a line for every (transitive) include.
+    headers = {match.group(1).strip() for match in MSVC_INCLUDE_LINE_PATTERN.finditer(header_search_process.stderr)} # Make unique. MSVC emits duplicate entries.
+    # Whatever's left is errors...
+    error_lines = [line for line in MSVC_INCLUDE_LINE_PATTERN.sub('', header_search_process.stderr).splitlines()
+        if not (source_path.endswith('/' + line) or source_path == line)] # ...after munching the source filename echoed the first part of the include output
     if error_lines: # Output all errors at the end so they aren't interlaced due to concurrency
         _print_header_finding_warning_once()
         print('\n'.join(error_lines), file=sys.stderr)
 
     should_cache = all('fatal error C1083:' not in error_line for error_line in error_lines)  # Error code for file not found (when trying to include). Without this, we'd wrongly get a subset of the headers and we might wrongly think the cache is still fresh because we wouldn't know that the formerly missing header had been generated.
     return headers, should_cache
+# Based on the locale, `cl.exe` will emit different marker strings. See also https://github.com/ninja-build/ninja/issues/613#issuecomment-885185024 and https://github.com/bazelbuild/bazel/pull/7966.
+# We can't just set the VSLANG environment variable to "1033" (English) and be done with it, because we can't assume the user has the English language pack installed.
+# Note that, if we're ever having problems with MSVC changing these strings too often, we can instead infer them by compiling some test files and passing /nologo. See https://github.com/ninja-build/ninja/issues/613#issuecomment-1465084387
+MSVC_INCLUDE_MARKERS = (
+    'Note: including file:', # English - United States
+    '注意: 包含文件: ', # Chinese - People's Republic of China
+    '注意: 包含檔案:', # Chinese - Taiwan
+    'Poznámka: Včetně souboru:', # Czech
+    'Hinweis: Einlesen der Datei:', # German - Germany
+    'Remarque : inclusion du fichier : ', # French - France
+    'Nota: file incluso ', # Italian - Italy
+    'メモ: インクルード ファイル: ', # Japanese
+    '참고: 포함 파일:', # Korean
+    'Uwaga: w tym pliku: ', # Polish
+    'Observação: incluindo arquivo:', # Portuguese - Brazil
+    'Примечание: включение файла: ', # Russian
+    'Not: eklenen dosya: ', # Turkish
+    'Nota: inclusión del archivo:', # Spanish - Spain (Modern Sort)
+)
+# Joined once, rather than per action.
+WINDOWS_DEFAULT_INCLUDE = os.pathsep.join((
+    # Begin: template filled by Bazel
+        {windows_default_include_paths}
+    # End:   template filled by Bazel
+))
+MSVC_INCLUDE_LINE_PATTERN = re.compile('^(?:' + '|'.join(re.escape(marker) for marker in MSVC_INCLUDE_MARKERS) + ')(.*)\n?', re.MULTILINE) # Whole lines starting with any of the markers, capturing the path after.
 
 
 def _is_relative_to(sub: pathlib.PurePath, parent: pathlib.PurePath):
@@ -495,39 +521,162 @@ def _is_relative_to(sub: pathlib.PurePath, parent: pathlib.PurePath):
      return True
 
 
+@functools.lru_cache(maxsize=None)
+def _get_normalized_workspace_prefix():
+    """Get the workspace root as a prefix for string comparisons in _file_is_in_main_workspace_and_not_external. Cached because that's called for every header."""
+    return os.path.normcase(os.environ["BUILD_WORKSPACE_DIRECTORY"]).replace(os.sep, '/').rstrip('/') + '/'
+
+
 def _file_is_in_main_workspace_and_not_external(file_str: str):
-    file_path = pathlib.PurePath(file_str)
-    if file_path.is_absolute():
-        workspace_absolute = pathlib.PurePath(os.environ["BUILD_WORKSPACE_DIRECTORY"])
-        if not _is_relative_to(file_path, workspace_absolute):
+    # Called for every header, so we stick to string operations rather than constructing pathlib paths.
+    # Normalize away things like `./` and `//`, as pathlib would, then to forward slashes (and, on Windows, case) for comparison.
+    file_str = os.path.normcase(os.path.normpath(file_str)).replace(os.sep, '/')
+    if os.path.isabs(file_str):
+        workspace_prefix = _get_normalized_workspace_prefix()
+        if not file_str.startswith(workspace_prefix):
             return False
-        file_path = _is_relative_to(file_path, workspace_absolute)
+        file_str = file_str[len(workspace_prefix):]
     # You can now assume that the path is relative to the workspace.
     # [Already assuming that relative paths are relative to the main workspace.]
 
     # some/file.h, but not external/some/file.h
     # also allows for things like bazel-out/generated/file.h
-    if _is_relative_to(file_path, pathlib.PurePath("external")):
+    if file_str.startswith('external/'):
         return False
 
     # ... but, ignore files in e.g. bazel-out/<configuration>/bin/external/
-    if file_path.parts[0] == 'bazel-out' and file_path.parts[3] == 'external':
+    parts = file_str.split('/', 4)
+    if parts[0] == 'bazel-out' and len(parts) > 3 and parts[3] == 'external':
         return False
 
     return True
 
 
-def _get_headers(compile_action, source_path: str):
-    """Gets the headers used by a particular compile command.
+def _get_output_files(compile_args: typing.List[str]):
+    """Gets the (object file, dependency file) written by a compile command, either of which may be None if not found.
 
-    Relatively slow. Requires running the C preprocessor.
+    Finds both in a single pass over the arguments.
     """
-    # Hacky, but hopefully this is a temporary workaround for the clangd issue mentioned in the caller (https://github.com/clangd/clangd/issues/123)
-    # Runs a modified version of the compile command to piggyback on the compiler's preprocessing and header searching.
+    output_file = None
+    dep_file = None
+    for i, arg in enumerate(compile_args):
+        # As a reference, clang docs: https://clang.llvm.org/docs/ClangCommandLineReference.html#cmdoption-clang1-o-file
+        if output_file is None:
+            if arg == '-o' or arg == '--output': # clang/gcc. Docs https://clang.llvm.org/docs/ClangCommandLineReference.html
+                output_file = compile_args[i+1]
+            elif arg.startswith(('/Fo', '-Fo')): # MSVC *and clang*. MSVC docs https://docs.microsoft.com/en-us/cpp/build/reference/compiler-options-listed-alphabetically
+                output_file = arg[3:]
+            elif arg.startswith('--output='):
+                output_file = arg[9:]
+        if dep_file is None and arg.startswith('-MF'): # clang/gcc
+            if len(arg) > 3: # Either appended, like -MF<file>
+                dep_file = arg[3:]
+            else: # Or after as a separate arg, like -MF <file>
+                dep_file = compile_args[i+1]
+        if output_file is not None and dep_file is not None:
+            break
+    return output_file, dep_file
 
-    # As an alternative approach, you might consider trying to get the headers by inspecting the Middlemen actions in the aquery output, but I don't see a way to get just the ones actually #included--or an easy way to get the system headers--without invoking the preprocessor's header search logic.
-        # For more on this, see https://github.com/hedronvision/bazel-compile-commands-extractor/issues/5#issuecomment-1031148373
 
+def _open_header_cache(cache_path: str):
+    """Open (or create) the header cache database, closing it again if it can't be set up."""
+    # Autocommit (isolation_level=None), since each write stands alone. Wait (timeout) if another run of this tool is writing.
+    connection = sqlite3.connect(cache_path, timeout=60, isolation_level=None, check_same_thread=False)
+    try:
+        # Write-ahead logging makes our many small writes cheap and keeps them from blocking reads.
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS headers (cache_key TEXT PRIMARY KEY, action_key TEXT NOT NULL, cached_time REAL NOT NULL, headers TEXT NOT NULL)')
+    except sqlite3.Error:
+        connection.close()
+        raise
+    return connection
+
+
+@functools.lru_cache(maxsize=None)
+def _get_header_cache():
+    """Get a connection to the database caching the headers used by each compile action, or None if it's unavailable, in which case we'll just find headers without it.
+
+    One database, rather than a cache file alongside each object file, saves opening, parsing, and writing thousands of tiny files. Being transactional, it also can't be left corrupted if this tool is killed mid-write.
+    Lives in bazel-out, so it's cleaned along with Bazel's cache.
+    Shared between threads, so hold _get_header_cache.lock while calling and using. Prefer _read_header_cache and _write_header_cache, which do that for you.
+    """
+    if sqlite3 is None:
+        return None
+    cache_path = os.path.join('bazel-out', 'hedron_compile_commands_headers.sqlite')
+    try:
+        return _open_header_cache(cache_path)
+    except sqlite3.OperationalError as e:
+        # Locked by another run (past the timeout), read-only, or similar. That's not corruption, so we leave the database alone--someone else may well be using it--and just go without.
+        log_warning(f""">>> Couldn't open header cache {cache_path}: {e}
+    Continuing without it...""")
+        return None
+    except sqlite3.DatabaseError:
+        # Shouldn't happen, but if the database has somehow been corrupted, start over (once) rather than failing every run.
+        log_warning(f""">>> Ignoring corrupted header cache {cache_path}
+    If this message is appearing spontaneously or frequently, please file an issue.
+    Continuing gracefully...""")
+    try:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(cache_path + suffix):
+                os.remove(cache_path + suffix)
+        return _open_header_cache(cache_path)
+    except (OSError, sqlite3.Error) as e:
+        log_warning(f""">>> Couldn't recreate header cache {cache_path}: {e}
+    Continuing without it...""")
+        return None
+_get_header_cache.lock = threading.Lock()
+
+
+def _log_header_cache_error(error):
+    """Warn, just once per run, that a header cache lookup or write failed."""
+    if _log_header_cache_error.has_logged:
+        return
+    _log_header_cache_error.has_logged = True
+    log_warning(f""">>> Header cache error: {error}
+    Affected actions will just have their headers found without the cache.
+    If this message is appearing spontaneously or frequently, please file an issue.
+    Continuing gracefully...""")
+_log_header_cache_error.has_logged = False
+
+
+def _read_header_cache(cache_key: str):
+    """Returns the cached (action_key, cached_time, headers) row for cache_key, or None if there isn't a usable one."""
+    with _get_header_cache.lock:
+        header_cache = _get_header_cache()
+        if header_cache is None:
+            return None
+        try:
+            return header_cache.execute('SELECT action_key, cached_time, headers FROM headers WHERE cache_key = ?', (cache_key,)).fetchone()
+        except sqlite3.Error as e:  # E.g. corruption found past the pages we touched when opening. No cache for this action, rather than a crash.
+            _log_header_cache_error(e)
+            return None
+
+
+def _write_header_cache(cache_key: str, action_key: str, cached_time: float, headers: typing.Iterable[str]):
+    """Caches the headers for cache_key, if the cache is available. Failures just mean the action won't have a cache next run."""
+    with _get_header_cache.lock:
+        header_cache = _get_header_cache()
+        if header_cache is None:
+            return
+        try:
+            header_cache.execute('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)', (
+                cache_key,
+                action_key,
+                cached_time,
+                # Newline-delimited, since that's fastest to split back apart, and paths can't contain newlines in Makefile-format dependencies anyway. Sorted for deterministic output.
+                '\n'.join(sorted(headers)),
+            ))
+        except sqlite3.Error as e:
+            _log_header_cache_error(e)
+
+
+def _get_headers(compile_action, source_path: str):
+    """Gets the headers used by a particular compile command, as configured by exclude_headers.
+
+    Relatively slow. Requires running the C preprocessor, unless we can skip header finding altogether.
+    """
+    # Decide whether we need to find headers at all before doing any work.
     if {exclude_headers} == "all":
         return set()
     elif {exclude_headers} == "external" and not {exclude_external_sources} and compile_action.is_external:
@@ -535,79 +684,73 @@ def _get_headers(compile_action, source_path: str):
         # The `not {exclude_external_sources}`` clause makes sure is_external was precomputed; there are no external actions if they've already been filtered in the process of excluding external sources.
         return set()
 
-    output_file = None
-    for i, arg in enumerate(compile_action.arguments):
-        # As a reference, clang docs: https://clang.llvm.org/docs/ClangCommandLineReference.html#cmdoption-clang1-o-file
-        if arg == '-o' or arg == '--output': # clang/gcc. Docs https://clang.llvm.org/docs/ClangCommandLineReference.html
-            output_file = compile_action.arguments[i+1]
-            break
-        elif arg.startswith('/Fo') or arg.startswith('-Fo'): # MSVC *and clang*. MSVC docs https://docs.microsoft.com/en-us/cpp/build/reference/compiler-options-listed-alphabetically
-            output_file = arg[3:]
-            break
-        elif arg.startswith('--output='):
-            output_file = arg[9:]
-            break
+    # Memoized by action key, which covers the full command, because the same action can recur within a run--when multiple targets share dependencies. No lock needed; single dict operations are atomic, and at worst two threads would both find the same headers.
+    headers = _get_headers.all_headers_by_action_key.get(compile_action.actionKey)
+    if headers is None:
+        # Interned because the same header paths recur across thousands of actions, and we hold onto all of them. Frozen because the memoized set is shared.
+        headers = frozenset(map(sys.intern, _get_all_headers(compile_action, source_path)))
+        _get_headers.all_headers_by_action_key[compile_action.actionKey] = headers
+
+    # Filtered here, after the caching in _get_all_headers, so that headers served from its cache are filtered, too.
+    if {exclude_headers} == "external":
+        headers = {header for header in headers if _file_is_in_main_workspace_and_not_external(header)}
+
+    return headers
+_get_headers.all_headers_by_action_key = {}
+
+
+def _get_all_headers(compile_action, source_path: str):
+    """Gets all the headers used by a particular compile command, regardless of exclude_headers.
+
+    Relatively slow. Requires running the C preprocessor if we can't hit a cache.
+    """
+    # Hacky, but hopefully this is a temporary workaround for the clangd issue mentioned in the caller (https://github.com/clangd/clangd/issues/123)
+    # Runs a modified version of the compile command to piggyback on the compiler's preprocessing and header searching.
+
+    # As an alternative approach, you might consider trying to get the headers by inspecting the Middlemen actions in the aquery output, but I don't see a way to get just the ones actually #included--or an easy way to get the system headers--without invoking the preprocessor's header search logic.
+        # For more on this, see https://github.com/hedronvision/bazel-compile-commands-extractor/issues/5#issuecomment-1031148373
+
+    output_file, dep_file = _get_output_files(compile_action.arguments)
     # Since our output file parsing isn't complete, fall back on a warning message to solicit help.
     # A more full (if more involved) solution would be to get the primaryOutput for the action from the aquery output, but this should handle the cases Bazel emits.
-    if not output_file and not _get_headers.has_logged:
-        _get_headers.has_logged = True
+    if not output_file and not _get_all_headers.has_logged:
+        _get_all_headers.has_logged = True
         log_warning(f""">>> Please file an issue containing the following: Output file not detected in arguments {compile_action.arguments}.
-    Not a big deal; things will work but will be a little slower.
+    Not a big deal; things will still work.
     Thanks for your help!
     Continuing gracefully...""")
 
+    # Cache by output file, since Bazel only produces a given output with one action at a time, so stale entries get replaced rather than piling up.
+    # If we couldn't find the output file, though, fall back to caching by the action key, which is a hash of the action's command and inputs. That'll still get hits across runs, as long as nothing about the action changes.
+    cache_key = output_file or compile_action.actionKey
+
     # Check for a fresh cache of headers
     cached_headers = None
-    if output_file:
-        cache_file_path = output_file + ".hedron.compile-commands.headers" # Embed our cache in bazel's
-        if os.path.isfile(cache_file_path):
-            cache_last_modified = os.path.getmtime(cache_file_path) # Do before opening just as a basic hedge against concurrent write, even though we won't handle the concurrent delete case perfectly.
-            try:
-                with open(cache_file_path) as cache_file:
-                    action_key, cached_headers = json.load(cache_file)
-            except json.JSONDecodeError:
-                # Corrupted cache, which can happen if, for example, the user kills the program, since writes aren't atomic.
-                # But if it is the result of a bug, we want to print it before it's overwritten, so it can be reported
-                # For a real instance, see https://github.com/hedronvision/bazel-compile-commands-extractor/issues/60
-                with open(cache_file_path) as cache_file:
-                    log_warning(f""">>> Ignoring corrupted header cache {cache_file_path}
-    This is okay if you manually killed this tool earlier.
-    But if this message is appearing spontaneously or frequently, please file an issue containing the contents of the corrupted cache, below.
-    {cache_file.read()}
-    Thanks for your help!
-    Continuing gracefully...""")
-            else:
-                # Check cache freshness.
-                    # Action key validates that it corresponds to the same action arguments
-                    # And we also need to check that there aren't newer versions of the files
-                if (action_key == compile_action.actionKey
-                    and _get_cached_adjusted_modified_time(source_path) <= cache_last_modified
-                    and all(_get_cached_adjusted_modified_time(header_path) <= cache_last_modified for header_path in cached_headers)):
-                    return set(cached_headers)
-
+    cache_entry = _read_header_cache(cache_key)
+    if cache_entry:
+        action_key, cached_time, cached_headers = cache_entry
+        cached_headers = cached_headers.split('\n') if cached_headers else []
+        # Check cache freshness.
+            # Action key validates that it corresponds to the same action arguments
+            # And we also need to check that there aren't newer versions of the files
+        if (action_key == compile_action.actionKey
+            and _are_cached_files_unmodified_since(itertools.chain((source_path,), cached_headers), cached_time)):
+            return set(cached_headers)
+
+    search_time = time.time() # Taken before searching, so files modified during the search will register as newer than the cache.
     if compile_action.arguments[0].endswith('cl.exe'): # cl.exe and also clang-cl.exe
         headers, should_cache = _get_headers_msvc(compile_action, source_path)
     else:
-        headers, should_cache = _get_headers_gcc(compile_action, source_path, compile_action.actionKey)
+        headers, should_cache = _get_headers_gcc(compile_action, source_path, dep_file)
 
     # Cache for future use
-    if output_file and should_cache:
-        os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
-        with open(cache_file_path, 'w') as cache_file:
-            json.dump(
-                (compile_action.actionKey, list(headers)),
-                cache_file,
-                indent=2,
-                check_circular=False,
-            )
+    if should_cache:
+        _write_header_cache(cache_key, compile_action.actionKey, search_time, headers)
     elif not headers and cached_headers: # If we failed to get headers, we'll fall back on a stale cache.
         headers = set(cached_headers)
 
-    if {exclude_headers} == "external":
-        headers = {header for header in headers if _file_is_in_main_workspace_and_not_external(header)}
-
     return headers
-_get_headers.has_logged = False
+_get_all_headers.has_logged = False
 
 
 def _get_files(compile_action):
@@ -616,7 +759,7 @@ def _get_files(compile_action):
     # Getting the source file is a little trickier than it might seem.
 
     # First, we do the obvious thing: Filter args to those that look like source files.
-    source_file_candidates = [arg for arg in compile_action.arguments if not arg.startswith('-') and arg.endswith(_get_files.source_extensions)]
+    source_file_candidates = [arg for arg in compile_action.arguments if not arg.startswith('-') and os.path.splitext(arg)[1] in _get_files.source_extensions]
     assert source_file_candidates, f"No source files found in compile args: {compile_action.arguments}.\nPlease file an issue with this information!"
     source_file = source_file_candidates[0]
 
@@ -644,10 +787,10 @@ def _get_files(compile_action):
             source_index = compile_action.arguments.index('/c') + 1
 
         source_file = compile_action.arguments[source_index]
-        assert source_file.endswith(_get_files.source_extensions), f"Source file candidate, {source_file}, seems to be wrong.\nSelected from {compile_action.arguments}.\nPlease file an issue with this information!"
+        assert os.path.splitext(source_file)[1] in _get_files.source_extensions, f"Source file candidate, {source_file}, seems to be wrong.\nSelected from {compile_action.arguments}.\nPlease file an issue with this information!"
 
     # Warn gently about missing files
-    if not os.path.isfile(source_file):
+    if not _get_cached_is_file(source_file):
         if not _get_files.has_logged_missing_file_error: # Just log once; subsequent messages wouldn't add anything.
             _get_files.has_logged_missing_file_error = True
             log_warning(f""">>> A source file you compile doesn't (yet) exist: {source_file}
@@ -666,8 +809,10 @@ def _get_files(compile_action):
     # Why? clangd currently tries to infer commands for headers using files with similar paths. This often works really poorly for header-only libraries. The commands should instead have been inferred from the source files using those libraries... See https://github.com/clangd/clangd/issues/123 for more.
     # When that issue is resolved, we can stop looking for headers and just return the single source file.
 
+    source_extension = os.path.splitext(source_file)[1]
+
     # Assembly sources that are not preprocessed can't include headers
-    if os.path.splitext(source_file)[1] in _get_files.assembly_source_extensions:
+    if source_extension in _get_files.assembly_source_extensions:
         return {source_file}, set()
 
     header_files = _get_headers(compile_action, source_file)
@@ -678,12 +823,12 @@ def _get_files(compile_action):
     # https://github.com/clangd/clangd/issues/1173
     # https://github.com/clangd/clangd/issues/1263
     if (any(header_file.endswith('.h') for header_file in header_files)
-        and not source_file.endswith(_get_files.c_source_extensions)
-        and not any(arg.startswith('-x') or arg.startswith('--language') or arg.lower() in ('-objc', '-objc++', '/tc', '/tp') for arg in compile_action.arguments)):
+        and source_extension not in _get_files.c_source_extensions
+        and not any(arg.startswith(('-x', '--language')) or arg.lower() in ('-objc', '-objc++', '/tc', '/tp') for arg in compile_action.arguments)):
         if compile_action.arguments[0].endswith('cl.exe'): # cl.exe and also clang-cl.exe
             lang_flag = '/TP' # https://docs.microsoft.com/en-us/cpp/build/reference/tc-tp-tc-tp-specify-source-file-type
         else:
-            lang_flag = _get_files.extensions_to_language_args[os.path.splitext(source_file)[1]]
+            lang_flag = _get_files.extensions_to_language_args[source_extension]
         # Insert at front of (non executable) args, because --language is only supposed to take effect on files listed thereafter
         compile_action.arguments.insert(1, lang_flag)
 
@@ -700,7 +845,7 @@ _get_files.opencl_source_extensions = ('.cl',)
 _get_files.openclxx_source_extensions = ('.clcpp',)
 _get_files.assembly_source_extensions = ('.s', '.asm')
 _get_files.assembly_needing_c_preprocessor_source_extensions = ('.S',)
-_get_files.source_extensions = _get_files.c_source_extensions + _get_files.cpp_source_extensions + _get_files.objc_source_extensions + _get_files.objcpp_source_extensions + _get_files.cuda_source_extensions + _get_files.opencl_source_extensions + _get_files.openclxx_source_extensions + _get_files.assembly_source_extensions + _get_files.assembly_needing_c_preprocessor_source_extensions
+_get_files.source_extensions = frozenset(_get_files.c_source_extensions + _get_files.cpp_source_extensions + _get_files.objc_source_extensions + _get_files.objcpp_source_extensions + _get_files.cuda_source_extensions + _get_files.opencl_source_extensions + _get_files.openclxx_source_extensions + _get_files.assembly_source_extensions + _get_files.assembly_needing_c_preprocessor_source_extensions) # Set for fast lookup by extension, since we check every arg.
 _get_files.extensions_to_language_args = { # Note that clangd fails on the --language or -ObjC or -ObjC++ forms. See https://github.com/clangd/clangd/issues/1173#issuecomment-1226847416
     _get_files.c_source_extensions: '-xc',
     _get_files.cpp_source_extensions: '-xc++',
@@ -721,13 +866,13 @@ def _get_apple_SDKROOT(SDK_name: str):
     SDKROOT_maybe_versioned =  subprocess.check_output(
         ('xcrun', '--show-sdk-path', '-sdk', SDK_name.lower()),
         stderr=subprocess.DEVNULL,
-        encoding=locale.getpreferredencoding()
+        encoding=PREFERRED_ENCODING
     ).rstrip()
     # Unless xcode-select has been invoked (like for a beta) we'd expect, e.g.,  '/Applications/Xcode.app/Contents/Developer/Platforms/iPhoneOS.platform/Developer/SDKs/iPhoneOS<version>.sdk' or '/Library/Developer/CommandLineTools/SDKs/MacOSX.sdk'.
     version = subprocess.check_output(
         ('xcrun', '--show-sdk-version', '-sdk', SDK_name.lower()),
         stderr=subprocess.DEVNULL,
-        encoding=locale.getpreferredencoding()
+        encoding=PREFERRED_ENCODING
     ).rstrip()
     return SDKROOT_maybe_versioned.replace(version, '') # Strip version and use unversioned SDK symlink so the compile commands are still valid after an SDK update.
     # Traditionally stored in SDKROOT environment variable, but not provided by Bazel. See https://github.com/bazelbuild/bazel/issues/12852
@@ -741,16 +886,19 @@ def _get_apple_platform(compile_args: typing.List[str]):
     """
     # A bit gross, but Bazel specifies the platform name in one of the include paths, so we mine it from there.
     for arg in compile_args:
-        match = re.search('/Platforms/([a-zA-Z]+).platform/Developer/', arg)
+        if '/Platforms/' not in arg: # Cheap prefilter; most args are unrelated.
+            continue
+        match = APPLE_PLATFORM_PATTERN.search(arg)
         if match:
             return match.group(1)
     return None
+APPLE_PLATFORM_PATTERN = re.compile(r'/Platforms/([a-zA-Z]+)\.platform/Developer/')
 
 
 @functools.lru_cache(maxsize=None)
 def _get_apple_DEVELOPER_DIR():
     """Get path to xcode-select'd developer directory."""
-    return subprocess.check_output(('xcode-select', '--print-path'), encoding=locale.getpreferredencoding()).rstrip()
+    return subprocess.check_output(('xcode-select', '--print-path'), encoding=PREFERRED_ENCODING).rstrip()
     # Unless xcode-select has been invoked (like for a beta) we'd expect, e.g., '/Applications/Xcode.app/Contents/Developer' or '/Library/Developer/CommandLineTools'.
     # Traditionally stored in DEVELOPER_DIR environment variable, but not provided by Bazel. See https://github.com/bazelbuild/bazel/issues/12852
 
@@ -771,15 +919,21 @@ def _apple_platform_patch(compile_args: typing.List[str]):
         # We have to manually substitute out Bazel's macros so clang can parse the command
         # Code this mirrors is in https://github.com/bazelbuild/bazel/blob/master/tools/osx/crosstool/wrapped_clang.cc
         # Not complete--we're just swapping out the essentials, because there seems to be considerable turnover in the hacks they have in the wrapper.
-        compile_args = [arg for arg in compile_args if not arg.startswith('DEBUG_PREFIX_MAP_PWD') or arg == 'OSO_PREFIX_MAP_PWD'] # No need for debug prefix maps if compiling in place, not that we're compiling anyway.
         # We also have to manually figure out the values of SDKROOT and DEVELOPER_DIR, since they're missing from the environment variables Bazel provides.
         # Filed Bazel issue about the missing environment variables: https://github.com/bazelbuild/bazel/issues/12852
-        compile_args = [arg.replace('__BAZEL_XCODE_DEVELOPER_DIR__', _get_apple_DEVELOPER_DIR()) for arg in compile_args]
-        apple_platform = _get_apple_platform(compile_args)
+        apple_platform = _get_apple_platform(compile_args) # Mined from paths that don't depend on the substitutions.
         assert apple_platform, f"Apple platform not detected in CMD: {compile_args}"
-        compile_args = [arg.replace('__BAZEL_XCODE_SDKROOT__', _get_apple_SDKROOT(apple_platform)) for arg in compile_args]
+        # The lookups are cached, but we also hold a lock, so the many threads processing actions don't all miss the cache at once, each spawning their own xcode-select and xcrun processes.
+        with _apple_platform_patch.xcode_lookup_lock:
+            DEVELOPER_DIR = _get_apple_DEVELOPER_DIR()
+            SDKROOT = _get_apple_SDKROOT(apple_platform)
+        # Filter and substitute in a single pass, with the substitution values looked up once per action, above. Most args have nothing to substitute, so we check before replacing.
+        compile_args = [arg.replace('__BAZEL_XCODE_DEVELOPER_DIR__', DEVELOPER_DIR).replace('__BAZEL_XCODE_SDKROOT__', SDKROOT) if '__BAZEL_XCODE_' in arg else arg
+            for arg in compile_args
+            if not arg.startswith('DEBUG_PREFIX_MAP_PWD') or arg == 'OSO_PREFIX_MAP_PWD'] # No need for debug prefix maps if compiling in place, not that we're compiling anyway.
 
     return compile_args
+_apple_platform_patch.xcode_lookup_lock = threading.Lock()
 
 
 def _emscripten_platform_patch(compile_action):
@@ -787,9 +941,10 @@ def _emscripten_platform_patch(compile_action):
 
     This function has fixes specific to Emscripten platforms, but you should call it on all platforms. It'll determine whether the fixes should be applied or not
     """
-    emcc_driver = pathlib.Path(compile_action.arguments[0])
-    if not emcc_driver.name.startswith('emcc'):
+    # Checked with string operations before constructing a path, since this runs for every action, and few are Emscripten.
+    if not os.path.basename(compile_action.arguments[0]).startswith('emcc'):
         return compile_action.arguments
+    emcc_driver = pathlib.Path(compile_action.arguments[0])
 
     workspace_absolute = pathlib.PurePath(os.environ["BUILD_WORKSPACE_DIRECTORY"])
 
@@ -830,7 +985,7 @@ def _emscripten_platform_patch(compile_action):
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         env=environment,
-        encoding=locale.getpreferredencoding(),
+        encoding=PREFERRED_ENCODING,
         check=False, # We explicitly ignore errors and carry on.
     )
 
@@ -853,48 +1008,68 @@ END_ARGS_MARKER = '===HEDRON_COMPILE_COMMANDS_END_ARGS==='
 
 def _all_platform_patch(compile_args: typing.List[str]):
     """Apply de-Bazeling fixes to the compile command that are shared across target platforms."""
+    # Filtered in a single pass, since this runs over every arg of every action.
+    new_compile_args = []
+    args_to_skip = 0
+    for arg in compile_args:
+        if args_to_skip:
+            args_to_skip -= 1
+            continue
+
+        # Quick check first, since most args are kept. The gate and the filters both come from _all_platform_patch.filtered_args, so they can't get out of sync.
+        if arg.startswith(_all_platform_patch.filtered_arg_prefixes):
+            prefix = next(prefix for prefix in _all_platform_patch.filtered_args if arg.startswith(prefix))
+            args_to_drop = _all_platform_patch.filtered_args[prefix](arg)
+            if args_to_drop:
+                args_to_skip = args_to_drop - 1
+                continue
+
+        new_compile_args.append(arg)
+    compile_args = new_compile_args
+
+    compile_args[0] = _get_compiler_behind_ccache(compile_args[0])
+
+    # Any other general fixes would go here...
+
+    return compile_args
+# Args to filter out, keyed by prefix. Each filter takes an arg with its prefix and returns how many args to drop, starting with that one: 0 to keep it after all, 1 to drop it, or 2 to drop its separate value, too.
+_all_platform_patch.filtered_args = {
     # clangd writes module cache files to the wrong place
     # Without this fix, you get tons of module caches dumped into the VSCode root folder.
     # Filed clangd issue at: https://github.com/clangd/clangd/issues/655
     # Seems to have disappeared when we switched to aquery from action_listeners, but we'll leave it in until the bug is patched in case we start using C++ modules
-    compile_args = (arg for arg in compile_args if not arg.startswith('-fmodules-cache-path=bazel-out/'))
+    '-fmodules-cache-path=bazel-out/': lambda arg: 1,
 
     # We're transfering the commands as though they were compiled in place in the workspace; no need for prefix maps, so we'll remove them. This eliminates some postentially confusing Bazel variables, though I think clangd just ignores them anyway.
     # Some example:
     # -fdebug-prefix-map=__BAZEL_EXECUTION_ROOT__=.
     # -fdebug-prefix-map=__BAZEL_XCODE_DEVELOPER_DIR__=/PLACEHOLDER_DEVELOPER_DIR
-    compile_args = (arg for arg in compile_args if not arg.startswith('-fdebug-prefix-map'))
+    '-fdebug-prefix-map': lambda arg: 1,
 
     # When Bazel builds with gcc it adds -fno-canonical-system-headers to the command line, which clang tooling chokes on, since it does not understand this flag.
     # We'll remove this flag, until such time as clangd & clang-tidy gracefully ignore it. Tracking issues: https://github.com/clangd/clangd/issues/1004 and https://github.com/llvm/llvm-project/issues/61699.
     # For more context see: https://github.com/hedronvision/bazel-compile-commands-extractor/issues/21
-    compile_args = (arg for arg in compile_args if not arg == '-fno-canonical-system-headers')
+    '-fno-canonical-system-headers': lambda arg: int(arg == '-fno-canonical-system-headers'),
 
     # Strip out -gcc-toolchain to work around https://github.com/clangd/clangd/issues/1248
-    skip_next = False
-    new_compile_args = []
-    for arg in compile_args:
-        if arg.startswith('-gcc-toolchain'):
-            if len(arg) == len('-gcc-toolchain'):
-                skip_next = True
-        elif skip_next:
-            skip_next = False
-        else:
-            new_compile_args.append(arg)
-    compile_args = new_compile_args
+    '-gcc-toolchain': lambda arg: 2 if arg == '-gcc-toolchain' else 1, # Separate value arg follows if it's not attached.
+}
+_all_platform_patch.filtered_arg_prefixes = tuple(_all_platform_patch.filtered_args)
 
-    # Discover compilers that are actually symlinks to ccache--and replace them with the underlying compiler
-    if os.path.islink(compile_args[0]):
-        compiler_path = os.readlink(compile_args[0])  # MIN_PY=3.9 Switch to pathlib path.readlink()
-        if os.path.basename(compiler_path) == "ccache":
-            compiler = os.path.basename(compile_args[0])
-            real_compiler_path = shutil.which(compiler)
-            if real_compiler_path:
-                compile_args[0] = real_compiler_path
 
-    # Any other general fixes would go here...
+@functools.lru_cache(maxsize=None)
+def _get_compiler_behind_ccache(compiler: str):
+    """Discover compilers that are actually symlinks to ccache--and get the underlying compiler, returning others unchanged.
 
-    return compile_args
+    Cached because the same few compilers recur across every action, so there's no need to check the filesystem (and search PATH) each time.
+    """
+    if os.path.islink(compiler):
+        compiler_path = os.readlink(compiler)  # MIN_PY=3.9 Switch to pathlib path.readlink()
+        if os.path.basename(compiler_path) == "ccache":
+            real_compiler_path = shutil.which(os.path.basename(compiler))
+            if real_compiler_path:
+                return real_compiler_path
+    return compiler
 
 
 def _nvcc_patch(compile_args: typing.List[str]) -> typing.List[str]:
@@ -1118,7 +1293,7 @@ def _get_cpp_command_for_files(compile_action):
     # Done after getting files since we may execute NVCC to get the files.
     compile_action.arguments = _nvcc_patch(compile_action.arguments)
 
-    return source_files, header_files, compile_action.arguments
+    return source_files, header_files, compile_action.arguments, compile_action.actionKey
 
 
 def _convert_compile_commands(aquery_output):
@@ -1142,14 +1317,24 @@ def _convert_compile_commands(aquery_output):
 
     # Process each action from Bazelisms -> file paths and their clang commands
     # Threads instead of processes because most of the execution time is farmed out to subprocesses. No need to sidestep the GIL. Might change after https://github.com/clangd/clangd/issues/123 resolved
+    # Processes would also need some rework first: Child processes would each need their own header cache database connection (SQLite connections can't cross a fork), the once-only warnings and in-memory caches would become per-process, and spawn-based platforms (macOS, Windows) would re-run the check_python_version wrapper, which calls main() unconditionally at import.
     with concurrent.futures.ThreadPoolExecutor(
         max_workers=min(32, (os.cpu_count() or 1) + 4) # Backport. Default in MIN_PY=3.8. See "using very large resources implicitly on many-core machines" in https://docs.python.org/3/library/concurrent.futures.html#concurrent.futures.ThreadPoolExecutor
     ) as threadpool:
         outputs = threadpool.map(_get_cpp_command_for_files, aquery_output.actions)
 
     # Yield as compile_commands.json entries
-    header_files_already_written = set()
-    for source_files, header_files, compile_command_args in outputs:
+    # What we've already written is tracked across calls, because targets often share dependencies, and so actions.
+    header_files_already_written = _convert_compile_commands.header_files_already_written
+    workspace_directory = os.environ["BUILD_WORKSPACE_DIRECTORY"]
+    source_entries_already_written = _convert_compile_commands.source_entries_already_written
+    for source_files, header_files, compile_command_args, action_key in outputs:
+        # Skip exact duplicates of source entries, as from an action shared between targets. (We keep differing commands for the same source file, though, since they're all legitimately ways it's compiled.)
+        # Keyed on the action key rather than the arguments, since it's small, and a shared action has the same key in every target. Holding onto every command would make our memory use grow with the size of the output.
+        source_entries = {(source_file, action_key) for source_file in source_files}
+        source_files = [source_file for source_file in source_files if (source_file, action_key) not in source_entries_already_written]
+        source_entries_already_written |= source_entries
+
         # Only emit one entry per header
         # This makes the output vastly smaller, since large size has been a problem for users.
         # e.g. https://github.com/insufficiently-caffeinated/caffeine/pull/577
@@ -1167,8 +1352,10 @@ def _convert_compile_commands(aquery_output):
                 # Using `arguments' instead of 'command' because it's now preferred by clangd. Heads also that  shlex.join doesn't work for windows cmd, so you'd need to use windows_list2cmdline if we ever switched back. For more, see https://github.com/hedronvision/bazel-compile-commands-extractor/issues/8#issuecomment-1090262263
                 'arguments': compile_command_args,
                 # Bazel gotcha warning: If you were tempted to use `bazel info execution_root` as the build working directory for compile_commands...search ImplementationReadme.md to learn why that breaks.
-                'directory': os.environ["BUILD_WORKSPACE_DIRECTORY"],
+                'directory': workspace_directory,
             }
+_convert_compile_commands.header_files_already_written = set()
+_convert_compile_commands.source_entries_already_written = set()
 
 
 def _get_commands(target: str, flags: str):
@@ -1182,7 +1369,7 @@ def _get_commands(target: str, flags: str):
     # Note that positional arguments after -- are all interpreted as target patterns. (If it's at the end, then no worries.)
     # And that we have to look for targets. checking for a - prefix is not enough. Consider the case of `-c opt` leading to a false positive
     if ('--' in additional_flags[:-1]
-        or any(re.match(r'-?(@|:|//)', f) for f in additional_flags)):
+        or any(f.startswith(('@', ':', '//', '-@', '-:', '-//')) for f in additional_flags)):
         log_warning(""">>> The flags you passed seem to contain targets.
     Try adding them as targets in your refresh_compile_commands rather than flags.
     [Specifying targets at runtime isn't supported yet, and in a moment, Bazel will likely fail to parse without our help. If you need to be able to specify targets at runtime, and can't easily just add them to your refresh_compile_commands, please open an issue or file a PR. You may also want to refer to https://github.com/hedronvision/bazel-compile-commands-extractor/issues/62.]""")
@@ -1237,7 +1424,7 @@ def _get_commands(target: str, flags: str):
         # MIN_PY=3.7: Replace PIPEs with capture_output.
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        encoding=locale.getpreferredencoding(),
+        encoding=PREFERRED_ENCODING,
         check=False, # We explicitly ignore errors from `bazel aquery` and carry on.
     )
 
@@ -1247,7 +1434,10 @@ def _get_commands(target: str, flags: str):
     # The missing graph targets are not things we want to introspect anyway.
     # Tracking issue https://github.com/bazelbuild/bazel/issues/13007
     missing_targets_warning: typing.Pattern[str] = re.compile(r'(\(\d+:\d+:\d+\) )?(\033\[[\d;]+m)?WARNING: (\033\[[\d;]+m)?Targets were missing from graph:') # Regex handles --show_timestamps and --color=yes. Could use "in" if we ever need more flexibility.
-    aquery_process.stderr = '\n'.join(line for line in aquery_process.stderr.splitlines() if not missing_targets_warning.match(line))
+    if 'Targets were missing from graph:' in aquery_process.stderr: # Quick check before going line by line, since there's usually nothing to filter.
+        aquery_process.stderr = '\n'.join(line for line in aquery_process.stderr.splitlines() if not missing_targets_warning.match(line))
+    elif aquery_process.stderr.endswith('\n'): # Drop the one trailing newline the join above would have, since print adds one.
+        aquery_process.stderr = aquery_process.stderr[:-1]
     if aquery_process.stderr: print(aquery_process.stderr, file=sys.stderr)
 
     # Parse proto output from aquery
@@ -1258,6 +1448,9 @@ def _get_commands(target: str, flags: str):
         print("Bazel aquery failed. Command:", aquery_args, file=sys.stderr)
         log_warning(f">>> Failed extracting commands for {target}\n    Continuing gracefully...")
         return
+    # The raw output is large for big projects, and we no longer need it, so let it be freed rather than held through the (long) conversion below.
+    # Streaming the parse instead would need a third-party incremental JSON parser, and anyway, tagging external actions needs the targets, which can come after the actions.
+    aquery_process.stdout = None
 
     if not getattr(parsed_aquery_output, 'actions', None): # Unifies cases: No actions (or actions list is empty)
         if aquery_process.stderr:
@@ -1328,35 +1521,32 @@ def _ensure_external_workspaces_link_exists():
 def _ensure_gitignore_entries_exist():
     """Ensure `//compile_commands.json`, `//external`, and other useful entries are `.gitignore`'d if in a git repo."""
     # Silently check if we're (nested) within a git repository. It isn't sufficient to check for the presence of a `.git` directory, in case, e.g., the bazel workspace is nested inside the git repository or you're off in a git worktree.
-    git_dir_process = subprocess.run('git rev-parse --git-common-dir', # common-dir because despite current gitignore docs, there's just one info/exclude in the common git dir, not one in each of the worktree's git dirs.
-        shell=True,  # Ensure this will still fail with a nonzero error code even if `git` isn't installed, unifying error cases.
-        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-        encoding=locale.getpreferredencoding(),
-    )
+    # While we're at it, in the same git invocation, we also get the path to the workspace root (current working directory) from the git repository root.
+    try:
+        git_process = subprocess.run(['git', 'rev-parse', '--git-common-dir', '--show-prefix'], # common-dir because despite current gitignore docs, there's just one info/exclude in the common git dir, not one in each of the worktree's git dirs.
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            encoding=PREFERRED_ENCODING,
+        )
+    except OSError: # git isn't installed or can't be run. Caught directly, rather than running through a shell just to get a nonzero error code. Either way, this check is best-effort, so we skip it.
+        return
     # A nonzero error code indicates that we are not (nested) within a git repository.
-    if git_dir_process.returncode: return
+    if git_process.returncode: return
+    git_common_dir, pattern_prefix = git_process.stdout.split('\n')[:2] # One line per query, in order. The prefix line is empty at the repository root.
 
     # Write into the gitignore hidden inside the .git directory
     # This makes ignoring work automagically for people, while minimizing the code changes they have to think about or check in. https://github.com/hedronvision/bazel-compile-commands-extractor/pull/100 and https://github.com/hedronvision/bazel-compile-commands-extractor/issues/59 are examples of use cases that this simplifies. It also marginally simplifies the case where people can't commit use of this tool to the repo they're working on.
     # IMO tools should to do this more broadly, especially now that git is so dominant.
     # Hidden gitignore documented in https://git-scm.com/docs/gitignore
-    git_dir = pathlib.Path(git_dir_process.stdout.rstrip())
+    git_dir = pathlib.Path(git_common_dir)
     (git_dir / 'info').mkdir(exist_ok=True) # Some older git versions don't auto create .git/info/, creating an error on exclude file open. See https://github.com/hedronvision/bazel-compile-commands-extractor/issues/114 for more context. We'll create the .git/info/ if needed; the git docs don't guarantee its existance. (We could instead back to writing .gitignore in the repo and bazel workspace, but we don't because this case is rare and because future git versions would be within their rights to read .git/info/exclude but not auto-create .git/info/)
     hidden_gitignore_path = git_dir / 'info' / 'exclude'
 
-    # Get path to the workspace root (current working directory) from the git repository root
-    git_prefix_process = subprocess.run(['git', 'rev-parse', '--show-prefix'],
-        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-        encoding=locale.getpreferredencoding(),
-        check=True, # Should always succeed if the other did
-    )
-    pattern_prefix = git_prefix_process.stdout.rstrip()
-
     # Each (pattern, explanation) will be added to the `.gitignore` file if the pattern isn't present.
     needed_entries = [
         (f'/{pattern_prefix}external', "# Ignore the `external` link (that is added by `bazel-compile-commands-extractor`). The link differs between macOS/Linux and Windows, so it shouldn't be checked in. The pattern must not end with a trailing `/` because it's a symlink on macOS/Linux."),
         (f'/{pattern_prefix}bazel-*', "# Ignore links to Bazel's output. The pattern needs the `*` because people can change the name of the directory into which your repository is cloned (changing the `bazel-<workspace_name>` symlink), and must not end with a trailing `/` because it's a symlink on macOS/Linux. This ignore pattern should almost certainly be checked into a .gitignore in your workspace root, too, for folks who don't use this tool."),
         (f'/{pattern_prefix}compile_commands.json', "# Ignore generated output. Although valuable (after all, the primary purpose of `bazel-compile-commands-extractor` is to produce `compile_commands.json`!), it should not be checked in."),
+        (f'/{pattern_prefix}compile_commands.json.tmp', "# Ignore the temporary file that `compile_commands.json` is written to before being moved into place."),
         ('.cache/', "# Ignore the directory in which `clangd` stores its local index."),
     ]
 
@@ -1405,20 +1595,46 @@ def main():
         # End:   template filled by Bazel
     ]
 
-    compile_command_entries = []
-    for (target, flags) in target_flag_pairs:
-        compile_command_entries.extend(_get_commands(target, flags))
-
-    if not compile_command_entries:
-        log_error(""">>> Not (over)writing compile_commands.json, since no commands were extracted and an empty file is of no use.
+    # Chain output into compile_commands.json
+    # One compact entry per line. Still human readable (and diffable), but much faster for large projects: json.dump(..., indent=2) formats everything in pure Python, whereas encoding compactly with one shared encoder uses json's C accelerator.
+    encode = json.JSONEncoder(
+        separators=(',', ':'),
+        check_circular=False # For speed.
+    ).encode
+    # An action's entries come out one after another and share its arguments list, and all entries share the directory, so we only re-encode those when they change and splice the JSON in, rather than re-encoding the (long) arguments for every header.
+    # Just the last value is kept per field, so this doesn't grow with the size of the output.
+    last_encoded_by_field = {} # field -> (value, encoded "field":value member)
+    def encode_entry(entry):
+        members = []
+        for field, value in entry.items(): # Built from the entry itself, so fields added in _convert_compile_commands can't be dropped here. Same order as the entry, too.
+            last_encoded = last_encoded_by_field.get(field)
+            if last_encoded is None or last_encoded[0] is not value:
+                last_encoded = last_encoded_by_field[field] = (value, f'{encode(field)}:{encode(value)}')
+            members.append(last_encoded[1])
+        return '{' + ','.join(members) + '}'
+
+    # Entries are streamed out as they're extracted, rather than collected first, so memory doesn't grow with the size of the output. The large buffer keeps the number of write syscalls low.
+    # They go to a temporary file that's moved into place at the end, so tools never see a partial compile_commands.json, and so we don't clobber the last good one if nothing is extracted.
+    # Resolved, so that if compile_commands.json is a symlink, we replace its target rather than the link itself--and so the temporary file is on the same filesystem as the target, as os.replace requires.
+    output_path = os.path.realpath('compile_commands.json')
+    # A fixed name, rather than tempfile (whose files are private to the user, unlike what open() creates) or a per-process one, so that a leftover from a killed run is just overwritten next time, rather than accumulating. Gitignored alongside compile_commands.json.
+    temporary_output_path = output_path + '.tmp'
+    try:
+        with open(temporary_output_path, 'w', buffering=1<<20) as output_file:
+            entry_separator = '[\n'
+            for (target, flags) in target_flag_pairs:
+                for entry in _get_commands(target, flags):
+                    output_file.write(entry_separator)
+                    output_file.write(encode_entry(entry))
+                    entry_separator = ',\n'
+            output_file.write('\n]\n')
+
+        if entry_separator == '[\n': # Nothing written.
+            log_error(""">>> Not (over)writing compile_commands.json, since no commands were extracted and an empty file is of no use.
     There should be actionable warnings, above, that led to this.""")
-        sys.exit(1)
+            sys.exit(1)
 
-    # Chain output into compile_commands.json
-    with open('compile_commands.json', 'w') as output_file:
-        json.dump(
-            compile_command_entries,
-            output_file,
-            indent=2, # Yay, human readability!
-            check_circular=False # For speed.
-        )
+        os.replace(temporary_output_path, output_path)
+    finally:
+        if os.path.exists(temporary_output_path): # Clean up if we didn't make it to the end.
+            os.remove(temporary_output_path)